@@ -1,15 +1,50 @@
 import io
 import asyncio
+import csv
+import gzip
 import json
-from fastapi import FastAPI, UploadFile, File, Body, Form
+import re
+import secrets
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from fastapi import FastAPI, UploadFile, File, Body, Form, Request, Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
+from typing import Optional, Union
 from dotenv import load_dotenv
 import os
 from google import genai
 from google.genai import types
 from PyPDF2 import PdfReader, PdfWriter  # Install via pip install PyPDF2
 
+# Optional fast serializer / compressor for native JSON responses
+try:
+    import orjson  # Install via pip install orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli  # Install via pip install brotli
+except ImportError:
+    brotli = None
+
+# Optional image preprocessing for non-PDF uploads
+try:
+    from PIL import Image, ImageOps, ImageSequence, ImageStat  # Install via pip install Pillow
+except ImportError:
+    Image = None
+
+# Optional columnar export of line items (Arrow / Parquet)
+try:
+    import pyarrow as pa  # Install via pip install pyarrow
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -28,6 +63,108 @@ app.add_middleware(
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 client = genai.Client(api_key=GEMINI_API_KEY)
 
+# Response formats accepted by /process-pdf. "string" is the original
+# {"response": "<pretty-printed json string>"} shape kept for older clients;
+# "json" returns the document as native, compact JSON.
+RESPONSE_FORMATS = ("string", "json")
+
+# Payloads smaller than this are not worth compressing
+COMPRESSION_MIN_BYTES = 1024
+
+# Per-page model routing. Each page is scored from its text layer, images and
+# size, then sent to the cheapest tier that can handle it. Set PAGE_ROUTING=0
+# to send every page to the standard tier as before.
+ENABLE_PAGE_ROUTING = os.getenv("PAGE_ROUTING", "1") != "0"
+
+MODEL_TIERS = {
+    "light": {
+        "raw_model": "gemini-2.0-flash-lite",
+        "json_model": "gemini-2.0-flash-lite",
+    },
+    "standard": {
+        "raw_model": "gemini-2.0-flash-exp",
+        "json_model": "gemini-2.0-flash",
+    },
+}
+
+# List prices in USD per million (input, output) tokens, used to cost each
+# call from its reported token usage. Experimental models are priced as their
+# stable counterpart.
+MODEL_PRICING = {
+    "gemini-2.0-flash-lite": (0.075, 0.30),
+    "gemini-2.0-flash": (0.10, 0.40),
+    "gemini-2.0-flash-exp": (0.10, 0.40),
+}
+
+DEFAULT_MAX_OUTPUT_TOKENS = 40000
+MIN_MAX_OUTPUT_TOKENS = 2048
+
+# Page scoring thresholds
+BLANK_MAX_TEXT_CHARS = 5
+BLANK_MAX_BYTES = 2048
+LIGHT_MAX_TEXT_CHARS = 1500
+TABLE_MIN_NUMERIC_ROWS = 8
+
+# A raw extraction shorter than this fraction of the page's text layer is
+# treated as low confidence and escalated to the standard tier
+LOW_CONFIDENCE_TEXT_RATIO = 0.5
+
+# Image upload preprocessing: pages are auto-oriented, cropped to their
+# content, downscaled to IMAGE_MAX_DIMENSION on the long side and re-encoded
+# as JPEG (PNG for bilevel scans), in grayscale when the page has no
+# meaningful colour
+IMAGE_MAX_DIMENSION = 2048
+IMAGE_JPEG_QUALITY = 85
+# Pixels lighter than this (0-255) count as page margin / background
+IMAGE_MARGIN_THRESHOLD = 230
+IMAGE_MARGIN_PADDING = 16
+# Pages whose grayscale standard deviation is below this have no content
+IMAGE_BLANK_MAX_STDDEV = 2.0
+# Uploads beyond these limits are sent to the model unprocessed
+IMAGE_MAX_PAGES = 200
+IMAGE_MAX_TOTAL_PIXELS = 2_000_000_000
+# A page is converted to grayscale only if fewer than this fraction of its
+# pixels are noticeably coloured (stamps, highlights, coloured ink)
+IMAGE_GRAYSCALE_MIN_SATURATION = 60
+IMAGE_GRAYSCALE_MAX_COLOURED = 0.005
+
+# Documents with more line items than this are verified in parallel shards of
+# this size, with running balances and subtotals carried between shards
+VERIFY_SHARD_LINE_ITEMS = 50
+# At most this many shard verifications run against the model at once
+VERIFY_SHARD_CONCURRENCY = 8
+
+# An amount with optional currency, sign, parentheses, trailing minus and a
+# trailing CR/DR marker or unit (e.g. "hrs", "kg")
+AMOUNT_PATTERN = re.compile(
+    r"(?P<sign>-)?\s*(?P<open>\()?\s*(?P<sign2>-)?\s*(?:[A-Z]{3}\s*)?[$€£]?\s*"
+    r"(?P<number>\d+(?:\.\d+)?|\.\d+)\s*(?P<close>\))?\s*(?P<trailing>-)?\s*"
+    r"(?P<suffix>[A-Za-z.%]+)?"
+)
+
+# Statements label lines in the singular or plural ("Deposit", "Withdrawals")
+DEBIT_TRANSACTION = re.compile(r"\b(debits?|withdrawals?|dr)\b", re.IGNORECASE)
+CREDIT_TRANSACTION = re.compile(r"\b(credits?|deposits?|cr)\b", re.IGNORECASE)
+
+NUMERIC_TOKEN = re.compile(r"[-(]?\$?\d[\d,]*(?:\.\d+)?\)?")
+
+# Optional local store of invoice and receipt index fields (vendor, number,
+# date, total) used for duplicate detection. Off unless DOCUMENT_STORE_PATH is
+# set. Only these fields are kept, never the full extraction, and only for
+# documents extracted with these schemas whose extracted
+# documentMetadata.documentType is one of DOCUMENT_STORE_TYPES (compared
+# lowercase without punctuation). Tax forms, payroll, statements, purchase
+# orders and documents without a recognised type are never stored.
+DOCUMENT_STORE_PATH = os.getenv("DOCUMENT_STORE_PATH", "")
+DOCUMENT_STORE_SCHEMAS = ("generic",)
+DOCUMENT_STORE_TYPES = ("invoice", "bill", "receipt", "salesreceipt")
+# /documents is only served when this key is set and sent as X-API-Key
+DOCUMENT_STORE_API_KEY = os.getenv("DOCUMENT_STORE_API_KEY", "")
+
+# Legal-form suffixes ignored when comparing vendor names
+VENDOR_SUFFIXES = {"inc", "incorporated", "llc", "ltd", "limited", "co", "corp",
+                   "corporation", "company", "plc", "gmbh", "lp", "llp"}
+
 # Step 1: Raw extraction prompt remains unchanged.
 RAW_PROMPT = "List every single thing exactly as it appears on the document, each column and row, in full"
 
@@ -300,23 +437,19 @@ def detect_document_type(json_data):
     # Default to invoice verification rules if we can't determine
     return "invoice"
 
-async def verify_extraction(json_data):
+def build_verification_prompt(document_type, json_data, shard_instructions=""):
     """
-    Verify the mathematical accuracy of the extracted data by focusing on 
-    calculation discrepancies rather than trivial formatting differences.
+    Build the mathematical-verification prompt for a document or a shard of one.
     
     Parameters:
-    json_data (dict): The structured JSON data extracted from the document
+    document_type (str): Result of detect_document_type
+    json_data (dict): The data to verify
+    shard_instructions (str): Extra instructions when only part of the document is sent
     
     Returns:
-    dict: Original JSON with added extraction verification results
+    str: The prompt to send to the verifier
     """
-    try:
-        # First, detect document type to apply appropriate verification rules
-        document_type = detect_document_type(json_data)
-        
-        # Update the prompt to focus on mathematical verification
-        verification_prompt = f"""
+    return f"""
         Analyze this financial document data to verify MATHEMATICAL ACCURACY only.
         
         DOCUMENT TYPE: {document_type.upper()}
@@ -335,7 +468,7 @@ async def verify_extraction(json_data):
            - Document totals: sum of line totals = subtotal
            - Tax calculation: subtotal × tax rate = tax amount
            - Final total: subtotal + tax + fees - discounts = total amount
-        
+        {shard_instructions}
         Financial Data:
         {json.dumps(json_data, indent=2)}
         
@@ -359,60 +492,104 @@ async def verify_extraction(json_data):
         ONLY include discrepancies that are TRUE CALCULATION ERRORS where numbers don't add up correctly.
         DO NOT flag differences in formatting, string representations, or character encoding.
         """
+
+def filter_verification_results(verification_results):
+    """
+    Keep only significant calculation discrepancies in a verifier response.
+    
+    Parameters:
+    verification_results (dict): The parsed verifier response
+    
+    Returns:
+    dict: The same results with numerically-equal discrepancies removed
+    """
+    if "discrepancies" in verification_results and len(verification_results["discrepancies"]) > 0:
+        # Filter out any discrepancies where the numeric values are actually the same
+        significant_issues = []
+        for d in verification_results["discrepancies"]:
+            # Try to convert both values to floats for comparison
+            try:
+                expected = float(str(d.get("expectedValue", "0")).replace(",", ""))
+                actual = float(str(d.get("extractedValue", "0")).replace(",", ""))
+                
+                # Only keep discrepancies where values are numerically different
+                if abs(expected - actual) > 0.01:  # Allow for small rounding differences
+                    significant_issues.append(d)
+            except:
+                # If we can't convert to float, keep the discrepancy
+                significant_issues.append(d)
         
-        # Make the API call to Gemini
-        verification_response = await asyncio.to_thread(
-            client.models.generate_content,
-            model="gemini-2.0-flash",
-            contents=[verification_prompt],
-            config={
-                "max_output_tokens": 4000,
-                "response_mime_type": "application/json"
-            }
-        )
+        verification_results["discrepancies"] = significant_issues
         
-        # Extract verification results
-        try:
-            verification_results = json.loads(verification_response.text)
-            
-            # Keep only significant calculation discrepancies
-            if "discrepancies" in verification_results and len(verification_results["discrepancies"]) > 0:
-                # Filter out any discrepancies where the numeric values are actually the same
-                significant_issues = []
-                for d in verification_results["discrepancies"]:
-                    # Try to convert both values to floats for comparison
-                    try:
-                        expected = float(str(d.get("expectedValue", "0")).replace(",", ""))
-                        actual = float(str(d.get("extractedValue", "0")).replace(",", ""))
-                        
-                        # Only keep discrepancies where values are numerically different
-                        if abs(expected - actual) > 0.01:  # Allow for small rounding differences
-                            significant_issues.append(d)
-                    except:
-                        # If we can't convert to float, keep the discrepancy
-                        significant_issues.append(d)
-                
-                verification_results["discrepancies"] = significant_issues
-                
-                # Update the verification status based on filtered discrepancies
-                verification_results["extractionVerified"] = len(significant_issues) == 0
-                
-                # Update summary if needed
-                if len(significant_issues) == 0 and not verification_results["extractionVerified"]:
-                    verification_results["summary"] = "No significant calculation discrepancies found after filtering."
-                    verification_results["extractionVerified"] = True
-            
-            # Add verification results to the original JSON
-            json_data["extractionVerification"] = verification_results
-            
-        except json.JSONDecodeError as e:
-            # If the response isn't valid JSON, create a simple error structure
-            json_data["extractionVerification"] = {
-                "extractionVerified": False,
-                "discrepancies": [],
-                "summary": f"Error parsing verification results: {str(e)}",
-                "rawResponse": verification_response.text
-            }
+        # Update the verification status based on filtered discrepancies
+        verification_results["extractionVerified"] = len(significant_issues) == 0
+        
+        # Update summary if needed
+        if len(significant_issues) == 0 and not verification_results["extractionVerified"]:
+            verification_results["summary"] = "No significant calculation discrepancies found after filtering."
+            verification_results["extractionVerified"] = True
+    
+    return verification_results
+
+async def run_verification(prompt, max_output_tokens=4000):
+    """
+    Send a verification prompt to Gemini and parse the result.
+    
+    Parameters:
+    prompt (str): The verification prompt
+    max_output_tokens (int): Output-token limit for the verifier
+    
+    Returns:
+    dict: Filtered verification results, or an error structure if parsing fails
+    """
+    # Make the API call to Gemini
+    verification_response = await asyncio.to_thread(
+        client.models.generate_content,
+        model="gemini-2.0-flash",
+        contents=[prompt],
+        config={
+            "max_output_tokens": max_output_tokens,
+            "response_mime_type": "application/json"
+        }
+    )
+    
+    # Extract verification results
+    try:
+        return filter_verification_results(json.loads(verification_response.text))
+    except json.JSONDecodeError as e:
+        # If the response isn't valid JSON, create a simple error structure
+        return {
+            "extractionVerified": False,
+            "discrepancies": [],
+            "summary": f"Error parsing verification results: {str(e)}",
+            "rawResponse": verification_response.text
+        }
+
+async def verify_extraction(json_data):
+    """
+    Verify the mathematical accuracy of the extracted data by focusing on 
+    calculation discrepancies rather than trivial formatting differences.
+    Documents with many line items are verified in parallel shards.
+    
+    Parameters:
+    json_data (dict): The structured JSON data extracted from the document
+    
+    Returns:
+    dict: Original JSON with added extraction verification results
+    """
+    try:
+        # First, detect document type to apply appropriate verification rules
+        document_type = detect_document_type(json_data)
+        
+        line_items = json_data.get("lineItems")
+        if isinstance(line_items, list) and len(line_items) > VERIFY_SHARD_LINE_ITEMS:
+            json_data["extractionVerification"] = await verify_extraction_sharded(json_data, document_type)
+            return json_data
+        
+        verification_prompt = build_verification_prompt(document_type, json_data)
+        
+        # Add verification results to the original JSON
+        json_data["extractionVerification"] = await run_verification(verification_prompt)
         
         return json_data
         
@@ -425,46 +602,771 @@ async def verify_extraction(json_data):
         }
         return json_data
 
-async def process_page(page, schema="generic"):
-    # Write the individual page to a BytesIO stream.
-    pdf_writer = PdfWriter()
-    pdf_writer.add_page(page)
-    page_stream = io.BytesIO()
-    pdf_writer.write(page_stream)
-    page_stream.seek(0)
+def to_number(value):
+    """
+    Parse an extracted amount such as "$1,234.56", "(12.00)", "12.50 CR",
+    "40.00 DR", "1,234.56-" or "2 hrs" into a float. DR and trailing-minus
+    amounts are negative; a trailing unit is ignored.
+    
+    Returns:
+    float: The parsed value, or None if it isn't numeric
+    """
+    if isinstance(value, bool) or value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = str(value).strip().replace(",", "")
+    match = AMOUNT_PATTERN.fullmatch(text)
+    if not match:
+        return None
+    number = float(match.group("number"))
+    suffix = (match.group("suffix") or "").upper().rstrip(".")
+    negative = (
+        bool(match.group("open") and match.group("close"))
+        or bool(match.group("sign") or match.group("sign2"))
+        or bool(match.group("trailing"))
+        or suffix == "DR"
+    )
+    return -number if negative else number
 
-    # Create a Gemini Part from the page bytes.
-    file_part = types.Part.from_bytes(
-        data=page_stream.getvalue(),
-        mime_type="application/pdf"
+def signed_amount(item):
+    """
+    Get a line item's amount with the sign implied by its transaction type.
+    Statements usually extract debits and credits as positive amounts, so
+    Debit/Withdrawal lines count as negative and Credit/Deposit lines as
+    positive; untyped lines keep their extracted sign.
+    
+    Parameters:
+    item (dict): A line item
+    
+    Returns:
+    tuple: (signed amount or None, "debit", "credit" or None)
+    """
+    amount = to_number(item.get("totalPrice"))
+    if amount is None:
+        return None, None
+    transaction_type = str(item.get("transactionType") or "")
+    if DEBIT_TRANSACTION.search(transaction_type):
+        return -abs(amount), "debit"
+    if CREDIT_TRANSACTION.search(transaction_type):
+        return abs(amount), "credit"
+    return amount, None
+
+def shard_carry_state(line_items, shard_size):
+    """
+    Work out the state carried into each shard from the extracted line items,
+    so shards can be verified independently and in parallel.
+    
+    Parameters:
+    line_items (list): The document's line items
+    shard_size (int): Number of line items per shard
+    
+    Returns:
+    tuple: (one dict per shard with its item range, the running balance carried
+            in and the totals of all preceding shards; totals for the whole document)
+    """
+    shards = []
+    carried_balance = None
+    totals = {"net": 0.0, "credits": 0.0, "debits": 0.0}
+    for start in range(0, len(line_items), shard_size):
+        items = line_items[start:start + shard_size]
+        shards.append({
+            "start": start,
+            "end": start + len(items),
+            "carriedBalance": carried_balance,
+            "carriedTotals": {key: round(value, 2) for key, value in totals.items()},
+        })
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            amount, direction = signed_amount(item)
+            if amount is not None:
+                totals["net"] += amount
+                if direction == "credit":
+                    totals["credits"] += amount
+                elif direction == "debit":
+                    totals["debits"] -= amount
+            balance = to_number(item.get("balance"))
+            if balance is not None:
+                carried_balance = balance
+    return shards, {key: round(value, 2) for key, value in totals.items()}
+
+def describe_totals(totals):
+    """
+    Describe carried totals for a shard prompt.
+    """
+    return (f"credits {totals['credits']}, debits {totals['debits']} (as positive amounts), "
+            f"net {totals['net']} (credits minus debits, untyped lines at their extracted sign)")
+
+def build_shard_instructions(shard, shard_number, shard_count, total_items, document_totals):
+    """
+    Describe a shard's place in the document and its carried-forward state.
+    """
+    carried_balance = shard["carriedBalance"]
+    if carried_balance is None:
+        balance_rule = "Use the document's opening balance (if any) as the starting running balance."
+    else:
+        balance_rule = (f"The running balance carried forward from the previous shard is {carried_balance}. "
+                        f"Verify the first transaction in this shard starts from it.")
+    
+    if shard_number == shard_count:
+        totals_rule = (f"This is the FINAL shard. Line items in preceding shards total: {describe_totals(shard['carriedTotals'])}. "
+                       f"All line items in the document total: {describe_totals(document_totals)}. "
+                       f"Check the document-level totals using these sums: line totals = subtotal, subtotal + tax = total, "
+                       f"and for statements opening balance + credits - debits = closing balance.")
+    else:
+        totals_rule = "Do NOT check document-level totals (subtotal, total, closing balance); later shards contain the remaining line items."
+    
+    return f"""
+        5. SHARDED VERIFICATION: This request contains only line items {shard['start'] + 1}-{shard['end']} of {total_items} (shard {shard_number} of {shard_count}).
+           Verify each line item in this shard and the running balance from line to line.
+           {balance_rule}
+           {totals_rule}
+           In "location", refer to line items by their position in the full document.
+        """
+
+async def verify_extraction_sharded(json_data, document_type):
+    """
+    Verify a long document by splitting its line items into shards and
+    verifying them in parallel, then merging the results.
+    
+    Parameters:
+    json_data (dict): The structured JSON data extracted from the document
+    document_type (str): Result of detect_document_type
+    
+    Returns:
+    dict: Merged verification results in the extractionVerification structure
+    """
+    line_items = json_data["lineItems"]
+    # Every shard sees the document-level fields so it can resolve references to them
+    header = {key: value for key, value in json_data.items()
+              if key not in ("lineItems", "extractionVerification", "pageRouting")}
+    
+    shards, document_totals = shard_carry_state(line_items, VERIFY_SHARD_LINE_ITEMS)
+    
+    prompts = []
+    for shard_number, shard in enumerate(shards, start=1):
+        shard_data = dict(header)
+        shard_data["lineItems"] = line_items[shard["start"]:shard["end"]]
+        instructions = build_shard_instructions(
+            shard, shard_number, len(shards), len(line_items), document_totals
+        )
+        prompts.append(build_verification_prompt(document_type, shard_data, instructions))
+    
+    # Bound the number of concurrent model calls so long documents don't hit rate limits
+    semaphore = asyncio.Semaphore(VERIFY_SHARD_CONCURRENCY)
+    
+    async def verify_shard(prompt):
+        async with semaphore:
+            return await run_verification(prompt)
+    
+    results = await asyncio.gather(
+        *(verify_shard(prompt) for prompt in prompts),
+        return_exceptions=True
     )
+    
+    discrepancies = []
+    shard_summaries = []
+    verified = True
+    for shard_number, (shard, result) in enumerate(zip(shards, results), start=1):
+        if isinstance(result, Exception):
+            result = {
+                "extractionVerified": False,
+                "discrepancies": [],
+                "summary": f"Error during extraction verification: {str(result)}"
+            }
+        for d in result.get("discrepancies", []):
+            if isinstance(d, dict):
+                d["shard"] = shard_number
+            discrepancies.append(d)
+        verified = verified and bool(result.get("extractionVerified", False))
+        shard_summaries.append({
+            "shard": shard_number,
+            "lineItems": [shard["start"] + 1, shard["end"]],
+            "carriedBalance": shard["carriedBalance"],
+            "carriedTotals": shard["carriedTotals"],
+            "extractionVerified": result.get("extractionVerified", False),
+            "summary": result.get("summary", ""),
+        })
+    
+    if verified:
+        summary = f"All {len(shards)} shards verified with no significant calculation discrepancies."
+    else:
+        failed = [str(s["shard"]) for s in shard_summaries if not s["extractionVerified"]]
+        summary = (f"{len(discrepancies)} calculation discrepancies found across shards "
+                   f"{', '.join(failed)} of {len(shards)}.")
+    
+    return {
+        "extractionVerified": verified,
+        "discrepancies": discrepancies,
+        "summary": summary,
+        "shards": shard_summaries,
+    }
 
+def count_page_images(page):
+    """
+    Count the image XObjects drawn on a PDF page, including images nested in
+    Form XObjects (which is how many scanners wrap the page image).
+    
+    Parameters:
+    page (PageObject): The PyPDF2 page
+    
+    Returns:
+    int: Number of images referenced by the page resources
+    """
+    def count(resources, depth, seen):
+        resources = resources.get_object() if resources is not None else None
+        xobjects = resources.get("/XObject") if resources else None
+        if not xobjects or depth > 8:
+            return 0
+        xobjects = xobjects.get_object()
+        total = 0
+        for name in xobjects:
+            reference = xobjects.raw_get(name) if hasattr(xobjects, "raw_get") else xobjects[name]
+            key = getattr(reference, "idnum", None)
+            if key is not None:
+                if key in seen:
+                    continue
+                seen.add(key)
+            xobject = reference.get_object()
+            subtype = xobject.get("/Subtype")
+            if subtype == "/Image":
+                total += 1
+            elif subtype == "/Form":
+                total += count(xobject.get("/Resources"), depth + 1, seen)
+        return total
+    
+    try:
+        return count(page.get("/Resources"), 0, set())
+    except Exception:
+        return 0
+
+def score_page(page, page_bytes):
+    """
+    Cheaply score a page's complexity without calling a model.
+    
+    Parameters:
+    page (PageObject): The PyPDF2 page
+    page_bytes (bytes): The page written out as a standalone PDF
+    
+    Returns:
+    dict: Text density, image count, table detection and byte size
+    """
+    try:
+        text = page.extract_text() or ""
+    except Exception:
+        text = ""
+    
+    lines = [line for line in text.splitlines() if line.strip()]
+    # Rows with two or more amounts/numbers are a good proxy for table rows
+    numeric_rows = sum(1 for line in lines if len(NUMERIC_TOKEN.findall(line)) >= 2)
+    
+    return {
+        "textChars": len(text.strip()),
+        "textLines": len(lines),
+        "numericRows": numeric_rows,
+        "tableDetected": numeric_rows >= TABLE_MIN_NUMERIC_ROWS,
+        "imageCount": count_page_images(page),
+        "byteSize": len(page_bytes),
+    }
+
+def route_page(score):
+    """
+    Choose a model tier and output-token limit for a scored page.
+    
+    Parameters:
+    score (dict): The result of score_page
+    
+    Returns:
+    tuple: (tier name or "skip", max output tokens)
+    """
+    if (score["textChars"] < BLANK_MAX_TEXT_CHARS and score["imageCount"] == 0
+            and score["byteSize"] <= BLANK_MAX_BYTES):
+        return "skip", 0
+    
+    # Scanned pages have no usable text layer, so we can't size them. A page
+    # with no text but real content is treated as scanned even if its image
+    # wasn't found (e.g. inline images)
+    if score["textChars"] < BLANK_MAX_TEXT_CHARS:
+        return "standard", DEFAULT_MAX_OUTPUT_TOKENS
+    
+    # Text runs at roughly four characters per token and the structured JSON
+    # is several times larger than the text, so allow two output tokens per
+    # character of the page's text layer
+    max_tokens = min(DEFAULT_MAX_OUTPUT_TOKENS, max(MIN_MAX_OUTPUT_TOKENS, score["textChars"] * 2))
+    
+    if (score["tableDetected"] or score["imageCount"] > 0
+            or score["textChars"] > LIGHT_MAX_TEXT_CHARS):
+        return "standard", max_tokens
+    return "light", max_tokens
+
+def is_truncated(response):
+    """
+    Check whether a model response stopped because it hit the output-token limit.
+    """
+    try:
+        finish_reason = response.candidates[0].finish_reason
+    except (AttributeError, IndexError, TypeError):
+        return False
+    return "MAX_TOKENS" in str(finish_reason)
+
+def call_usage(response, model, step):
+    """
+    Record the token usage and cost of a single model call.
+    
+    Parameters:
+    response (GenerateContentResponse): The model response
+    model (str): The model that was called
+    step (str): Which extraction step the call was for ("raw" or "json")
+    
+    Returns:
+    dict: Prompt/output token counts and the cost in USD
+    """
+    usage = getattr(response, "usage_metadata", None)
+    prompt_tokens = getattr(usage, "prompt_token_count", None) or 0
+    output_tokens = getattr(usage, "candidates_token_count", None) or 0
+    return {
+        "step": step,
+        "model": model,
+        "promptTokens": prompt_tokens,
+        "outputTokens": output_tokens,
+        "costUsd": price_tokens(model, prompt_tokens, output_tokens),
+    }
+
+def price_tokens(model, prompt_tokens, output_tokens):
+    """
+    Price a token count at a model's list price (0 for unknown models).
+    """
+    input_price, output_price = MODEL_PRICING.get(model, (0.0, 0.0))
+    return (prompt_tokens * input_price + output_tokens * output_price) / 1_000_000
+
+async def extract_page_json(file_part, schema, tier, max_tokens):
+    """
+    Run the raw extraction and JSON formatting steps for a single page.
+    
+    Parameters:
+    file_part (Part): The Gemini Part containing the page
+    schema (str): Identifier for the schema to use
+    tier (str): Key into MODEL_TIERS
+    max_tokens (int): Output-token limit for both calls
+    
+    Returns:
+    tuple: (raw text, JSON text, whether either call was truncated, usage of both calls)
+    """
+    models = MODEL_TIERS[tier]
+    
     # Step 1: Extract raw text from the page.
     raw_response = await asyncio.to_thread(
         client.models.generate_content,
-        model="gemini-2.0-flash-exp",
+        model=models["raw_model"],
         contents=[RAW_PROMPT, file_part],
         config={
-            "max_output_tokens": 40000,
+            "max_output_tokens": max_tokens,
             "response_mime_type": "text/plain"
         }
     )
-    raw_text = raw_response.text
+    raw_text = raw_response.text or ""
 
     # Step 2: Convert the raw text into structured JSON using the schema-specific prompt
     json_prompt = generate_schema_prompt(schema, raw_text)
     json_response = await asyncio.to_thread(
         client.models.generate_content,
-        model="gemini-2.0-flash",
+        model=models["json_model"],
         contents=[json_prompt],
         config={
-            "max_output_tokens": 40000,
+            "max_output_tokens": max_tokens,
             "response_mime_type": "application/json"
         }
     )
     
+    truncated = is_truncated(raw_response) or is_truncated(json_response)
+    usage = [
+        call_usage(raw_response, models["raw_model"], "raw"),
+        call_usage(json_response, models["json_model"], "json"),
+    ]
+    return raw_text, json_response.text, truncated, usage
+
+def escalation_reason(score, raw_text, json_text, truncated):
+    """
+    Decide whether a page's extraction should be retried on a stronger tier.
+    
+    Returns:
+    str: Why the page should be escalated, or None to keep the result
+    """
+    if truncated:
+        return "output truncated"
+    try:
+        json.loads(json_text)
+    except (TypeError, json.JSONDecodeError):
+        return "invalid JSON"
+    if score["textChars"] and len(raw_text.strip()) < score["textChars"] * LOW_CONFIDENCE_TEXT_RATIO:
+        return "low confidence"
+    return None
+
+def prepare_pdf_page(page, reader_lock):
+    """
+    Write a page out as a standalone PDF and score it. PyPDF2 reads pages
+    lazily from the shared reader, so this runs under the reader's lock.
+    
+    Parameters:
+    page (PageObject): The PyPDF2 page
+    reader_lock (Lock): Lock guarding the page's PdfReader
+    
+    Returns:
+    tuple: (page bytes, score from score_page)
+    """
+    with reader_lock:
+        # Write the individual page to a BytesIO stream.
+        pdf_writer = PdfWriter()
+        pdf_writer.add_page(page)
+        page_stream = io.BytesIO()
+        pdf_writer.write(page_stream)
+        page_bytes = page_stream.getvalue()
+        return page_bytes, score_page(page, page_bytes)
+
+async def process_page(page, schema="generic", page_number=1, reader_lock=None, allow_skip=True):
+    """
+    Extract structured JSON from a single PDF page, routing it to a model tier
+    based on its complexity.
+    
+    Parameters:
+    page (PageObject): The PyPDF2 page
+    schema (str): Identifier for the schema to use
+    page_number (int): 1-based page number, used in the routing record
+    reader_lock (Lock): Lock shared by all pages of the same PdfReader
+    allow_skip (bool): Whether a page that scores blank may be skipped
+    
+    Returns:
+    tuple: (JSON text to merge or None for skipped pages, routing record)
+    """
+    # Text extraction and the PDF round-trip are CPU-bound; keep them off the event loop
+    page_bytes, score = await asyncio.to_thread(
+        prepare_pdf_page, page, reader_lock or threading.Lock()
+    )
+    if ENABLE_PAGE_ROUTING:
+        tier, max_tokens = route_page(score)
+    else:
+        tier, max_tokens = "standard", DEFAULT_MAX_OUTPUT_TOKENS
+    if tier == "skip" and not allow_skip:
+        tier, max_tokens = "standard", DEFAULT_MAX_OUTPUT_TOKENS
+    
+    return await extract_routed_page(
+        page_bytes, "application/pdf", schema, page_number, score, tier, max_tokens
+    )
+
+async def process_image_page(image_bytes, mime_type, schema="generic", page_number=1, blank=False):
+    """
+    Extract structured JSON from a single (preprocessed) image page. Images have
+    no text layer to size them by, so they always use the standard tier.
+    
+    Parameters:
+    image_bytes (bytes): The encoded image
+    mime_type (str): MIME type of image_bytes
+    schema (str): Identifier for the schema to use
+    page_number (int): 1-based page number, used in the routing record
+    blank (bool): Whether preprocessing found the page to be empty
+    
+    Returns:
+    tuple: (JSON text to merge or None for skipped pages, routing record)
+    """
+    score = {
+        "textChars": 0,
+        "textLines": 0,
+        "numericRows": 0,
+        "tableDetected": False,
+        "imageCount": 0 if blank else 1,
+        "byteSize": len(image_bytes),
+    }
+    if ENABLE_PAGE_ROUTING and blank:
+        tier, max_tokens = "skip", 0
+    else:
+        tier, max_tokens = "standard", DEFAULT_MAX_OUTPUT_TOKENS
+    
+    return await extract_routed_page(
+        image_bytes, mime_type, schema, page_number, score, tier, max_tokens
+    )
+
+async def extract_routed_page(page_bytes, mime_type, schema, page_number, score, tier, max_tokens):
+    """
+    Run extraction for a routed page, escalating to the standard tier when the
+    result looks wrong.
+    
+    Returns:
+    tuple: (JSON text to merge or None for skipped pages, routing record)
+    """
+    routing = {
+        "page": page_number,
+        "score": score,
+        "tier": tier,
+        "maxOutputTokens": max_tokens,
+        "modelCalls": 0,
+        "calls": [],
+        "escalated": False,
+    }
+    
+    # Blank pages never reach the model
+    if tier == "skip":
+        return None, routing
+
+    # Create a Gemini Part from the page bytes.
+    file_part = types.Part.from_bytes(
+        data=page_bytes,
+        mime_type=mime_type
+    )
+    
+    raw_text, json_text, truncated, usage = await extract_page_json(file_part, schema, tier, max_tokens)
+    routing["modelCalls"] += 2
+    routing["calls"].extend(usage)
+    
+    # Retry on the standard tier with the full limit if the cheap attempt looks wrong
+    reason = escalation_reason(score, raw_text, json_text, truncated)
+    if reason and (tier != "standard" or max_tokens < DEFAULT_MAX_OUTPUT_TOKENS):
+        raw_text, json_text, truncated, usage = await extract_page_json(
+            file_part, schema, "standard", DEFAULT_MAX_OUTPUT_TOKENS
+        )
+        routing["modelCalls"] += 2
+        routing["calls"].extend(usage)
+        routing.update({
+            "escalated": True,
+            "escalationReason": reason,
+            "tier": "standard",
+            "maxOutputTokens": DEFAULT_MAX_OUTPUT_TOKENS,
+        })
+    
+    routing["models"] = MODEL_TIERS[routing["tier"]]
+    
     # Return the JSON response to be merged later
-    return json_response.text
+    return json_text, routing
+
+def is_near_grayscale(image):
+    """
+    Check whether an RGB image can be converted to grayscale without losing
+    meaningful colour.
+    """
+    saturation = image.resize((128, 128)).convert("HSV").split()[1]
+    histogram = saturation.histogram()
+    coloured = sum(histogram[IMAGE_GRAYSCALE_MIN_SATURATION:])
+    return coloured / sum(histogram) < IMAGE_GRAYSCALE_MAX_COLOURED
+
+def preprocess_image(image):
+    """
+    Prepare a single image page for extraction: auto-orient, flatten, convert
+    to grayscale where safe, crop margins and downscale.
+    
+    Parameters:
+    image (Image): The decoded page
+    
+    Returns:
+    tuple: (processed image, dict describing what was done)
+    """
+    details = {"originalSize": list(image.size)}
+    
+    # EXIF orientation 1 (or none) means the pixels are already upright
+    details["rotated"] = image.getexif().get(0x0112, 1) != 1
+    if details["rotated"]:
+        image = ImageOps.exif_transpose(image)
+    
+    # Flatten transparency onto white and normalise the mode
+    if image.mode in ("RGBA", "LA", "P", "PA"):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, "white")
+        background.paste(image, mask=image.split()[-1])
+        image = background
+    elif image.mode.startswith("I") or image.mode == "F":
+        # 16/32-bit data would clip on a plain convert; stretch the frame's
+        # own range onto 0-255 instead
+        image = image.convert("F")
+        low, high = image.getextrema()
+        scale = 255.0 / (high - low) if high > low else 0.0
+        image = image.point(lambda p: (p - low) * scale).convert("L")
+    elif image.mode not in ("L", "RGB"):
+        image = image.convert("L" if image.mode == "1" else "RGB")
+    
+    details["grayscale"] = image.mode == "L"
+    if image.mode == "RGB" and is_near_grayscale(image):
+        image = image.convert("L")
+        details["grayscale"] = True
+    
+    gray = image if image.mode == "L" else image.convert("L")
+    # A page is only blank if it has practically no contrast at all
+    details["blank"] = ImageStat.Stat(gray).stddev[0] < IMAGE_BLANK_MAX_STDDEV
+    
+    # Crop to the bounding box of anything darker than the background
+    bbox = gray.point(lambda p: 255 if p < IMAGE_MARGIN_THRESHOLD else 0).getbbox()
+    details["cropped"] = False
+    if bbox:
+        left, top, right, bottom = bbox
+        bbox = (max(0, left - IMAGE_MARGIN_PADDING), max(0, top - IMAGE_MARGIN_PADDING),
+                min(image.width, right + IMAGE_MARGIN_PADDING), min(image.height, bottom + IMAGE_MARGIN_PADDING))
+        if bbox != (0, 0, image.width, image.height):
+            image = image.crop(bbox)
+            details["cropped"] = True
+    
+    details["downscaled"] = max(image.size) > IMAGE_MAX_DIMENSION
+    if details["downscaled"]:
+        image.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION), Image.LANCZOS)
+    
+    details["processedSize"] = list(image.size)
+    return image, details
+
+def preprocess_image_upload(file_content, content_type):
+    """
+    Split an image upload into pages (multi-page TIFFs fan out to one page per
+    frame) and preprocess each page.
+    
+    Parameters:
+    file_content (bytes): The uploaded file
+    content_type (str): MIME type of the upload
+    
+    Returns:
+    tuple: (list of pages as dicts with bytes, mimeType and blank,
+            preprocessing report or None if the upload was passed through)
+    """
+    passthrough = [{"bytes": file_content, "mimeType": content_type, "blank": False}]
+    if Image is None or not (content_type or "").startswith("image/"):
+        return passthrough, None
+    
+    started = time.perf_counter()
+    try:
+        pages, page_reports = preprocess_image_pages(file_content, content_type)
+    except Exception as e:
+        # Anything Pillow can't handle (including decompression bombs) is sent as uploaded
+        print(f"Error preprocessing image upload, sending it unprocessed: {str(e)}")
+        return passthrough, None
+    
+    # Never skip every page of an upload; let the model decide instead
+    if all(page["blank"] for page in pages):
+        for page, details in zip(pages, page_reports):
+            page["blank"] = details["blank"] = False
+    
+    processed_bytes = sum(page["bytes"] for page in page_reports)
+    report = {
+        "pageCount": len(pages),
+        "originalBytes": len(file_content),
+        "processedBytes": processed_bytes,
+        "bytesSaved": len(file_content) - processed_bytes,
+        "savingsPercent": round(100 * (1 - processed_bytes / len(file_content)), 1) if file_content else 0.0,
+        "preprocessingMs": round((time.perf_counter() - started) * 1000, 1),
+        "pages": page_reports,
+    }
+    return pages, report
+
+def preprocess_image_pages(file_content, content_type):
+    """
+    Decode, preprocess and re-encode each frame of an image upload in turn, so
+    only one decoded frame is held in memory at a time.
+    
+    Parameters:
+    file_content (bytes): The uploaded file
+    content_type (str): MIME type of the upload
+    
+    Returns:
+    tuple: (list of pages as dicts with bytes, mimeType and blank, per-page reports)
+    """
+    source = Image.open(io.BytesIO(file_content))
+    frame_count = getattr(source, "n_frames", 1)
+    if frame_count > IMAGE_MAX_PAGES:
+        raise ValueError(f"Image has {frame_count} frames, more than the limit of {IMAGE_MAX_PAGES}")
+    
+    pages = []
+    page_reports = []
+    total_pixels = 0
+    for page_number, frame in enumerate(ImageSequence.Iterator(source), start=1):
+        # Pillow's decompression-bomb check is per frame, so also bound the total
+        total_pixels += frame.width * frame.height
+        if total_pixels > IMAGE_MAX_TOTAL_PIXELS:
+            raise ValueError(f"Image frames exceed the limit of {IMAGE_MAX_TOTAL_PIXELS} pixels in total")
+        bilevel = frame.mode == "1"
+        image, details = preprocess_image(frame.copy())
+        output = io.BytesIO()
+        if bilevel:
+            # Bilevel scans compress far better losslessly than as JPEG
+            image = image.point(lambda p: 255 if p >= 128 else 0).convert("1")
+            image.save(output, format="PNG", optimize=True)
+            mime_type = "image/png"
+        else:
+            image.save(output, format="JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+            mime_type = "image/jpeg"
+        page_bytes = output.getvalue()
+        
+        # A single page that only got re-encoded is kept as uploaded if that's smaller
+        geometry_changed = details["rotated"] or details["cropped"] or details["downscaled"]
+        if (frame_count == 1 and not geometry_changed and len(page_bytes) >= len(file_content)
+                and content_type in ("image/jpeg", "image/png", "image/webp")):
+            page_bytes, mime_type = file_content, content_type
+            details["recompressed"] = False
+        else:
+            details["recompressed"] = True
+        
+        details.update({"page": page_number, "bytes": len(page_bytes), "mimeType": mime_type})
+        page_reports.append(details)
+        pages.append({"bytes": page_bytes, "mimeType": mime_type, "blank": details["blank"]})
+    
+    return pages, page_reports
+
+def summarize_page_routing(routings):
+    """
+    Summarize per-page routing decisions, the token usage and cost of every
+    call, and the savings against running the same pages on the standard tier.
+    
+    The baseline re-prices the tokens of each page's final attempt at the
+    standard tier's models; escalated pages also pay for their first attempt.
+    Skipped pages have no usage to price, so they are only counted.
+    
+    Parameters:
+    routings (list): Routing records returned by process_page
+    
+    Returns:
+    dict: The per-page decisions plus an aggregate summary
+    """
+    standard = MODEL_TIERS["standard"]
+    baseline_calls = 2 * len(routings)
+    model_calls = sum(r["modelCalls"] for r in routings)
+    
+    usage_by_model = {}
+    cost = 0.0
+    baseline_cost = 0.0
+    for r in routings:
+        for call in r["calls"]:
+            totals = usage_by_model.setdefault(
+                call["model"], {"calls": 0, "promptTokens": 0, "outputTokens": 0, "costUsd": 0.0}
+            )
+            totals["calls"] += 1
+            totals["promptTokens"] += call["promptTokens"]
+            totals["outputTokens"] += call["outputTokens"]
+            totals["costUsd"] += call["costUsd"]
+            cost += call["costUsd"]
+        # The last two calls are the attempt whose result was kept
+        for call in r["calls"][-2:]:
+            baseline_cost += price_tokens(
+                standard[f"{call['step']}_model"], call["promptTokens"], call["outputTokens"]
+            )
+    
+    for totals in usage_by_model.values():
+        totals["costUsd"] = round(totals["costUsd"], 6)
+    
+    tiers = {}
+    for r in routings:
+        tiers[r["tier"]] = tiers.get(r["tier"], 0) + 1
+    
+    return {
+        "enabled": ENABLE_PAGE_ROUTING,
+        "pages": routings,
+        "summary": {
+            "pageCount": len(routings),
+            "pagesByTier": tiers,
+            "pagesSkipped": tiers.get("skip", 0),
+            "pagesEscalated": sum(1 for r in routings if r["escalated"]),
+            "modelCalls": model_calls,
+            "modelCallsSaved": baseline_calls - model_calls,
+            "usageByModel": usage_by_model,
+            "promptTokens": sum(t["promptTokens"] for t in usage_by_model.values()),
+            "outputTokens": sum(t["outputTokens"] for t in usage_by_model.values()),
+            "costUsd": round(cost, 6),
+            "baselineCostUsd": round(baseline_cost, 6),
+            "costSavedUsd": round(baseline_cost - cost, 6),
+        },
+    }
 
 def deep_merge(base, addition):
     """
@@ -513,15 +1415,25 @@ def merge_page_results(page_results):
     Merge JSON results from multiple pages.
     For document-level fields, we assume they are the same across pages and only keep the first occurrence.
     For list fields, we concatenate them, regardless of where they appear in the JSON structure.
+    Top-level line items are tagged with the page they came from (sourcePage).
     """
     merged = None
     
     # Process each page
-    for result in page_results:
+    for page_number, result in enumerate(page_results, start=1):
+        # Skipped (blank) pages have nothing to merge
+        if result is None:
+            continue
         try:
             data = json.loads(result)
         except json.JSONDecodeError:
             continue  # Optionally log or handle the error
+        
+        # Record which page each line item came from before the lists are concatenated
+        if isinstance(data, dict) and isinstance(data.get("lineItems"), list):
+            for item in data["lineItems"]:
+                if isinstance(item, dict):
+                    item["sourcePage"] = page_number
             
         if merged is None:
             merged = data
@@ -535,67 +1447,723 @@ def merge_page_results(page_results):
             
     return merged
 
+def project_fields(json_data, fields):
+    """
+    Keep only the requested top-level fields of the document.
+    
+    Parameters:
+    json_data (dict): The merged document
+    fields (str): Comma-separated top-level keys (e.g. "lineItems,financialData");
+                  an empty string keeps the whole document
+    
+    Returns:
+    dict: The projected document
+    """
+    wanted = [f.strip() for f in fields.split(",") if f.strip()]
+    if not wanted or not isinstance(json_data, dict):
+        return json_data
+    return {key: json_data[key] for key in wanted if key in json_data}
+
+def serialize_compact(payload):
+    """
+    Serialize a payload to compact JSON bytes, using orjson when it is installed.
+    orjson rejects some values the standard library accepts (e.g. integers wider
+    than 64 bits in long account numbers), so those fall back to json.dumps.
+    
+    Parameters:
+    payload: Any JSON-serializable value
+    
+    Returns:
+    bytes: UTF-8 encoded JSON without indentation or extra whitespace
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(payload)
+        except (orjson.JSONEncodeError, TypeError):
+            pass
+    return json.dumps(payload, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+def compress_body(body, accept_encoding):
+    """
+    Pick a compression scheme from the client's Accept-Encoding header.
+    Brotli is preferred when available, then gzip; small bodies are left as-is.
+    
+    Parameters:
+    body (bytes): The serialized response body
+    accept_encoding (str): Value of the Accept-Encoding request header
+    
+    Returns:
+    tuple: (body bytes, content-encoding or None)
+    """
+    if len(body) < COMPRESSION_MIN_BYTES:
+        return body, None
+    
+    accepted = set()
+    for token in accept_encoding.lower().split(","):
+        name, *params = [part.strip() for part in token.split(";")]
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        # Encodings with q=0 (in any spelling) are refused
+        if name and quality > 0:
+            accepted.add(name)
+    
+    if brotli is not None and "br" in accepted:
+        return brotli.compress(body, quality=5), "br"
+    if "gzip" in accepted:
+        return gzip.compress(body, compresslevel=6), "gzip"
+    return body, None
+
+def encode_json_response(payload, accept_encoding):
+    """
+    Build a compact, optionally compressed JSON response.
+    
+    Parameters:
+    payload: The JSON-serializable response payload
+    accept_encoding (str): Value of the Accept-Encoding request header
+    
+    Returns:
+    Response: The encoded response
+    """
+    body, encoding = compress_body(serialize_compact(payload), accept_encoding)
+    headers = {"Vary": "Accept-Encoding"}
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type="application/json", headers=headers)
+
 @app.post("/process-pdf")
-async def process_file(file: UploadFile = File(...), schema: str = Form("generic")):
+async def process_file(
+    request: Request,
+    file: UploadFile = File(...),
+    schema: str = Form("generic"),
+    response_format: str = Form("string"),
+    fields: str = Form(""),
+):
     file_content = await file.read()
     
+    if response_format not in RESPONSE_FORMATS:
+        return {"error": f"Unsupported response_format '{response_format}'",
+                "detail": f"Expected one of: {', '.join(RESPONSE_FORMATS)}"}
+    
     try:
         if file.content_type == "application/pdf":
             pdf_reader = PdfReader(io.BytesIO(file_content))
+            reader_lock = threading.Lock()
             # Process each page concurrently using the per-page processing function.
-            tasks = [process_page(page, schema) for page in pdf_reader.pages]
-            page_results = await asyncio.gather(*tasks)
+            tasks = [
+                process_page(page, schema, page_number, reader_lock)
+                for page_number, page in enumerate(pdf_reader.pages, start=1)
+            ]
+            page_outputs = await asyncio.gather(*tasks)
+            
+            # Never skip every page of a document; let the model decide instead
+            if page_outputs and all(routing["tier"] == "skip" for _, routing in page_outputs):
+                page_outputs = await asyncio.gather(*(
+                    process_page(page, schema, page_number, reader_lock, allow_skip=False)
+                    for page_number, page in enumerate(pdf_reader.pages, start=1)
+                ))
+            page_results = [json_text for json_text, _ in page_outputs]
             
             # Merge the JSON results from each page.
             merged_result = merge_page_results(page_results)
+            if merged_result is None:
+                return {"error": "Request failed", "detail": "No page produced valid JSON output"}
             
             # Perform extraction verification on the complete document
             final_result = await verify_extraction(merged_result)
             
-            combined_response_text = json.dumps(final_result, indent=2)
+            # Record how each page was routed (added after verification so it
+            # doesn't end up in the verification prompt)
+            if isinstance(final_result, dict):
+                final_result["pageRouting"] = summarize_page_routing(
+                    [routing for _, routing in page_outputs]
+                )
         else:
-            # For non-PDF files, process with schema selection
-            file_part = types.Part.from_bytes(
-                data=file_content,
-                mime_type=file.content_type
+            # For non-PDF files, preprocess the image and fan multi-page TIFFs
+            # out into pages that go through the same pipeline as PDF pages
+            pages, preprocessing = await asyncio.to_thread(
+                preprocess_image_upload, file_content, file.content_type
             )
-            raw_response = await asyncio.to_thread(
-                client.models.generate_content,
-                model="gemini-2.0-flash-exp",
-                contents=[RAW_PROMPT, file_part],
-                config={
-                    "max_output_tokens": 40000,
-                    "response_mime_type": "text/plain"
-                }
-            )
-            raw_text = raw_response.text
+            extraction_started = time.perf_counter()
+            tasks = [
+                process_image_page(page["bytes"], page["mimeType"], schema, page_number, page["blank"])
+                for page_number, page in enumerate(pages, start=1)
+            ]
+            page_outputs = await asyncio.gather(*tasks)
+            page_results = [json_text for json_text, _ in page_outputs]
             
-            # Use schema-specific prompt template
-            json_prompt = generate_schema_prompt(schema, raw_text)
+            merged_result = merge_page_results(page_results)
+            if merged_result is None:
+                return {"error": "Request failed", "detail": "No page produced valid JSON output"}
             
-            json_response = await asyncio.to_thread(
-                client.models.generate_content,
-                model="gemini-2.0-flash",
-                contents=[json_prompt],
-                config={
-                    "max_output_tokens": 40000,
-                    "response_mime_type": "application/json"
-                }
+            final_result = await verify_extraction(merged_result)
+            final_result["pageRouting"] = summarize_page_routing(
+                [routing for _, routing in page_outputs]
             )
-            
-            # For non-PDF files (single page), add extraction verification
+            if preprocessing:
+                preprocessing["extractionMs"] = round((time.perf_counter() - extraction_started) * 1000, 1)
+                final_result["imagePreprocessing"] = preprocessing
+        
+        # Record invoices and receipts and flag ones we've already seen. Storage
+        # is best-effort; it must never fail a finished extraction.
+        if DOCUMENT_STORE_PATH and schema in DOCUMENT_STORE_SCHEMAS and isinstance(final_result, dict):
             try:
-                json_data = json.loads(json_response.text)
-                final_json = await verify_extraction(json_data)
-                combined_response_text = json.dumps(final_json, indent=2)
-            except json.JSONDecodeError:
-                combined_response_text = json_response.text
+                if is_storable_document(final_result):
+                    final_result["duplicateCheck"] = await asyncio.to_thread(
+                        ingest_document, final_result, file.filename, schema
+                    )
+            except Exception as e:
+                print(f"Error storing extraction result: {str(e)}")
+        
+        if response_format == "json":
+            # Native JSON: no pretty-printing, no double encoding
+            if not isinstance(final_result, str):
+                final_result = project_fields(final_result, fields)
+            # Serializing and compressing large documents is CPU-bound
+            return await asyncio.to_thread(
+                encode_json_response,
+                {"response": final_result},
+                request.headers.get("accept-encoding", "")
+            )
+        
+        if isinstance(final_result, str):
+            combined_response_text = final_result
+        else:
+            combined_response_text = json.dumps(project_fields(final_result, fields), indent=2)
 
         # Return the merged Gemini response.
         return {"response": combined_response_text.strip()}
     except Exception as e:
         return {"error": "Request failed", "detail": str(e)}
 
+# Line item columns in export order, with the type of each column. Every
+# numeric column is followed by a "<name>Raw" column holding the text as
+# extracted, so values that can't be parsed as numbers are never lost.
+EXPORT_NUMERIC_FIELDS = ("quantity", "unitPrice", "totalPrice", "tax", "balance")
+EXPORT_COLUMNS = [
+    ("lineNumber", "int"),
+    ("sourcePage", "int"),
+    ("itemID", "str"),
+    ("description", "str"),
+    ("quantity", "float"),
+    ("quantityRaw", "str"),
+    ("unit", "str"),
+    ("unitPrice", "float"),
+    ("unitPriceRaw", "str"),
+    ("totalPrice", "float"),
+    ("totalPriceRaw", "str"),
+    ("tax", "float"),
+    ("taxRaw", "str"),
+    ("transactionType", "str"),
+    ("balance", "float"),
+    ("balanceRaw", "str"),
+    ("category", "str"),
+    ("verificationFlagged", "bool"),
+    ("discrepancyTypes", "str"),
+]
+
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+# Rows written per CSV chunk / Arrow record batch / Parquet row group
+EXPORT_BATCH_ROWS = 5000
+
+# Leading characters that make spreadsheet apps treat a CSV cell as a formula
+CSV_FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+LINE_REFERENCE = re.compile(r"(?:line\s*item|item|line|row|transaction)\s*#?\s*(\d+)", re.IGNORECASE)
+
+def line_item_flags(json_data, item_count):
+    """
+    Map verification discrepancies back to the line items they refer to.
+    
+    Parameters:
+    json_data (dict): The merged document, including extractionVerification
+    item_count (int): Number of line items in the document
+    
+    Returns:
+    dict: 0-based line item index to the discrepancy types that reference it
+    """
+    flags = {}
+    verification = json_data.get("extractionVerification")
+    if not isinstance(verification, dict):
+        return flags
+    for d in verification.get("discrepancies") or []:
+        if not isinstance(d, dict):
+            continue
+        for match in LINE_REFERENCE.finditer(str(d.get("location", ""))):
+            index = int(match.group(1)) - 1
+            if 0 <= index < item_count:
+                flags.setdefault(index, []).append(str(d.get("type", "Discrepancy")))
+    return flags
+
+def line_item_batches(json_data):
+    """
+    Yield the document's line items as column-oriented batches of at most
+    EXPORT_BATCH_ROWS rows, so only one batch of columns exists at a time.
+    
+    Parameters:
+    json_data (dict): The merged document
+    
+    Returns:
+    generator: Dicts of column name to a list of values, one per line item in the batch
+    """
+    items = [item for item in json_data.get("lineItems") or [] if isinstance(item, dict)]
+    flags = line_item_flags(json_data, len(items))
+    
+    for start in range(0, len(items), EXPORT_BATCH_ROWS):
+        batch = items[start:start + EXPORT_BATCH_ROWS]
+        indexes = range(start, start + len(batch))
+        columns = {
+            "lineNumber": [index + 1 for index in indexes],
+            "verificationFlagged": [index in flags for index in indexes],
+            "discrepancyTypes": ["; ".join(flags[index]) if index in flags else None for index in indexes],
+        }
+        for name in EXPORT_NUMERIC_FIELDS:
+            values = [item.get(name) for item in batch]
+            columns[name] = [to_number(v) for v in values]
+            columns[f"{name}Raw"] = [None if v is None else str(v) for v in values]
+        for name, kind in EXPORT_COLUMNS:
+            if name in columns:
+                continue
+            values = [item.get(name) for item in batch]
+            if kind == "int":
+                columns[name] = [v if isinstance(v, int) and not isinstance(v, bool) else None for v in values]
+            else:
+                columns[name] = [None if v is None else str(v) for v in values]
+        yield columns
+
+def arrow_schema():
+    """
+    The Arrow schema for exported line items.
+    """
+    arrow_types = {"int": pa.int64(), "float": pa.float64(), "str": pa.string(), "bool": pa.bool_()}
+    return pa.schema([(name, arrow_types[kind]) for name, kind in EXPORT_COLUMNS])
+
+def arrow_batches(json_data):
+    """
+    Yield Arrow record batches of at most EXPORT_BATCH_ROWS rows.
+    """
+    schema = arrow_schema()
+    for columns in line_item_batches(json_data):
+        yield pa.record_batch(
+            [pa.array(columns[field.name], type=field.type) for field in schema],
+            schema=schema
+        )
+
+def csv_safe(value):
+    """
+    Neutralise extracted text that a spreadsheet would run as a formula
+    (=, +, -, @, tab or carriage return at the start) by prefixing a quote.
+    """
+    if value and value[0] in CSV_FORMULA_PREFIXES:
+        return "'" + value
+    return value
+
+def stream_csv(json_data):
+    """
+    Stream line items as CSV, one chunk per EXPORT_BATCH_ROWS rows.
+    """
+    names = [name for name, _ in EXPORT_COLUMNS]
+    text_columns = {name for name, kind in EXPORT_COLUMNS if kind == "str"}
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(names)
+    yield buffer.getvalue().encode("utf-8")
+    for columns in line_item_batches(json_data):
+        for name in text_columns:
+            columns[name] = [csv_safe(value) for value in columns[name]]
+        buffer.seek(0)
+        buffer.truncate(0)
+        writer.writerows(zip(*(columns[name] for name in names)))
+        yield buffer.getvalue().encode("utf-8")
+
+def stream_arrow(json_data):
+    """
+    Stream line items in the Arrow IPC streaming format, one message per batch.
+    """
+    yield arrow_schema().serialize().to_pybytes()
+    for batch in arrow_batches(json_data):
+        yield batch.serialize().to_pybytes()
+    # End-of-stream marker
+    yield b"\xff\xff\xff\xff\x00\x00\x00\x00"
+
+class ChunkSink(io.RawIOBase):
+    """
+    Write-only file that buffers what the Parquet writer produces until it is
+    drained, while reporting the absolute position the writer relies on for
+    its footer offsets.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+    
+    def writable(self):
+        return True
+    
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+    
+    def tell(self):
+        return self.position
+    
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+def stream_parquet(json_data):
+    """
+    Stream line items as Parquet, sending each row group as soon as it is written.
+    """
+    sink = ChunkSink()
+    with pq.ParquetWriter(sink, arrow_schema()) as writer:
+        for batch in arrow_batches(json_data):
+            writer.write_batch(batch, row_group_size=EXPORT_BATCH_ROWS)
+            data = sink.drain()
+            if data:
+                yield data
+    # Closing the writer adds the footer
+    yield sink.drain()
+
+# Define request model for line item export
+class LineItemExportRequest(BaseModel):
+    document: Union[dict, str]  # Merged /process-pdf result, as an object or the "string" response
+    format: str = "csv"
+
+@app.post("/export-line-items")
+async def export_line_items(request: LineItemExportRequest):
+    export_format = request.format.lower()
+    if export_format not in EXPORT_FORMATS:
+        return {"error": f"Unsupported export format '{request.format}'",
+                "detail": f"Expected one of: {', '.join(EXPORT_FORMATS)}"}
+    if export_format != "csv" and pa is None:
+        return {"error": f"Export format '{export_format}' requires pyarrow to be installed"}
+    
+    document = request.document
+    if isinstance(document, str):
+        try:
+            document = json.loads(document)
+        except json.JSONDecodeError as e:
+            return {"error": "Document is not valid JSON", "detail": str(e)}
+    if not isinstance(document, dict):
+        return {"error": "Document must be a JSON object"}
+    
+    streams = {"csv": stream_csv, "arrow": stream_arrow, "parquet": stream_parquet}
+    
+    return StreamingResponse(
+        streams[export_format](document),
+        media_type=EXPORT_FORMATS[export_format],
+        headers={"Content-Disposition": f'attachment; filename="line_items.{export_format}"'}
+    )
+
+DOCUMENT_STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    id INTEGER PRIMARY KEY,
+    ingested_at TEXT NOT NULL,
+    file_name TEXT,
+    schema TEXT,
+    document_type TEXT,
+    vendor TEXT,
+    vendor_normalized TEXT,
+    document_number TEXT,
+    document_number_normalized TEXT,
+    document_date TEXT,
+    total_amount_cents INTEGER,
+    currency TEXT,
+    line_item_count INTEGER NOT NULL DEFAULT 0,
+    duplicate_of INTEGER REFERENCES documents(id)
+);
+CREATE INDEX IF NOT EXISTS idx_documents_vendor_number
+    ON documents (vendor_normalized, document_number_normalized);
+CREATE INDEX IF NOT EXISTS idx_documents_number ON documents (document_number_normalized);
+CREATE INDEX IF NOT EXISTS idx_documents_vendor_date_amount
+    ON documents (vendor_normalized, document_date, total_amount_cents);
+CREATE INDEX IF NOT EXISTS idx_documents_date ON documents (document_date);
+CREATE INDEX IF NOT EXISTS idx_documents_amount ON documents (total_amount_cents);
+"""
+
+_store_connection = None
+_store_lock = threading.Lock()
+
+def get_document_store():
+    """
+    Open (once) the SQLite document store and make sure its tables exist.
+    
+    Returns:
+    Connection: The shared sqlite3 connection
+    """
+    global _store_connection
+    if _store_connection is None:
+        connection = sqlite3.connect(DOCUMENT_STORE_PATH, check_same_thread=False)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(DOCUMENT_STORE_SCHEMA)
+        _store_connection = connection
+    return _store_connection
+
+def normalize_vendor(name):
+    """
+    Normalize a vendor name for matching: lowercase, no punctuation, and no
+    leading "the" or trailing legal-form suffixes (Inc, LLC, ...).
+    """
+    if not name:
+        return None
+    words = re.sub(r"[^a-z0-9]+", " ", str(name).lower()).split()
+    if words and words[0] == "the":
+        words = words[1:]
+    while words and words[-1] in VENDOR_SUFFIXES:
+        words = words[:-1]
+    return " ".join(words) or None
+
+def normalize_document_number(number):
+    """
+    Normalize a document number for matching: uppercase alphanumerics only.
+    """
+    if not number:
+        return None
+    return re.sub(r"[^A-Z0-9]", "", str(number).upper()) or None
+
+def document_index_fields(json_data):
+    """
+    Pull the indexed fields out of a merged document.
+    
+    Parameters:
+    json_data (dict): The merged document
+    
+    Returns:
+    dict: Column values for the documents table (without bookkeeping columns)
+    """
+    # Model output doesn't always follow the schema, so every level is checked
+    def as_dict(value):
+        return value if isinstance(value, dict) else {}
+    
+    def as_text(value):
+        return value if isinstance(value, (str, int, float)) and not isinstance(value, bool) else None
+    
+    metadata = as_dict(json_data.get("documentMetadata"))
+    financial = as_dict(json_data.get("financialData"))
+    vendor = as_text(as_dict(as_dict(json_data.get("partyInformation")).get("vendor")).get("name")) \
+        or as_text(as_dict(metadata.get("source")).get("name"))
+    total = to_number(as_text(financial.get("totalAmount")))
+    line_items = json_data.get("lineItems")
+    
+    return {
+        "document_type": as_text(metadata.get("documentType")),
+        "vendor": vendor,
+        "vendor_normalized": normalize_vendor(vendor),
+        "document_number": as_text(metadata.get("documentNumber")),
+        "document_number_normalized": normalize_document_number(as_text(metadata.get("documentNumber"))),
+        "document_date": as_text(metadata.get("documentDate")) or None,
+        "total_amount_cents": None if total is None else int(round(total * 100)),
+        "currency": as_text(financial.get("currency")),
+        "line_item_count": len(line_items) if isinstance(line_items, list) else 0,
+    }
+
+def is_storable_document(json_data):
+    """
+    Check whether the extracted document type is one the store records.
+    
+    Parameters:
+    json_data (dict): The merged document
+    
+    Returns:
+    bool: True for invoices and receipts
+    """
+    metadata = json_data.get("documentMetadata")
+    document_type = metadata.get("documentType") if isinstance(metadata, dict) else None
+    if not isinstance(document_type, str):
+        return False
+    return re.sub(r"[^a-z]", "", document_type.lower()) in DOCUMENT_STORE_TYPES
+
+def find_duplicates(connection, fields):
+    """
+    Look up stored documents that are likely the same invoice.
+    A matching vendor and document number is a duplicate; without a document
+    number, a matching vendor, date and total is treated as one.
+    
+    Parameters:
+    connection (Connection): The document store
+    fields (dict): Result of document_index_fields for the incoming document
+    
+    Returns:
+    list: Matching documents with what they matched on
+    """
+    vendor = fields["vendor_normalized"]
+    number = fields["document_number_normalized"]
+    columns = "id, file_name, ingested_at, document_number, document_date, total_amount_cents"
+    
+    if number:
+        if vendor:
+            rows = connection.execute(
+                f"SELECT {columns} FROM documents WHERE vendor_normalized = ? "
+                f"AND document_number_normalized = ? ORDER BY id LIMIT 20",
+                (vendor, number)
+            ).fetchall()
+        else:
+            rows = connection.execute(
+                f"SELECT {columns} FROM documents WHERE document_number_normalized = ? "
+                f"AND total_amount_cents IS ? ORDER BY id LIMIT 20",
+                (number, fields["total_amount_cents"])
+            ).fetchall()
+        matched_on = "vendor, documentNumber" if vendor else "documentNumber, totalAmount"
+    elif vendor and fields["document_date"] and fields["total_amount_cents"] is not None:
+        rows = connection.execute(
+            f"SELECT {columns} FROM documents WHERE vendor_normalized = ? "
+            f"AND document_date = ? AND total_amount_cents = ? ORDER BY id LIMIT 20",
+            (vendor, fields["document_date"], fields["total_amount_cents"])
+        ).fetchall()
+        matched_on = "vendor, documentDate, totalAmount"
+    else:
+        return []
+    
+    return [
+        {
+            "documentId": row["id"],
+            "fileName": row["file_name"],
+            "ingestedAt": row["ingested_at"],
+            "documentNumber": row["document_number"],
+            "documentDate": row["document_date"],
+            "totalAmount": None if row["total_amount_cents"] is None else row["total_amount_cents"] / 100,
+            "matchedOn": matched_on,
+        }
+        for row in rows
+    ]
+
+def ingest_document(json_data, file_name=None, schema=None):
+    """
+    Check a merged document against the store for duplicates, then store its
+    index fields.
+    
+    Parameters:
+    json_data (dict): The merged document
+    file_name (str): Original upload file name
+    schema (str): Schema the document was extracted with
+    
+    Returns:
+    dict: The stored document id and any duplicate matches
+    """
+    fields = document_index_fields(json_data)
+    with _store_lock:
+        connection = get_document_store()
+        matches = find_duplicates(connection, fields)
+        row = dict(
+            fields,
+            ingested_at=datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            file_name=file_name,
+            schema=schema,
+            duplicate_of=matches[0]["documentId"] if matches else None,
+        )
+        with connection:
+            cursor = connection.execute(
+                f"INSERT INTO documents ({', '.join(row)}) VALUES ({', '.join('?' for _ in row)})",
+                list(row.values())
+            )
+    
+    return {
+        "documentId": cursor.lastrowid,
+        "isDuplicate": bool(matches),
+        "matches": matches,
+    }
+
+def query_documents(vendor=None, document_number=None, date_from=None, date_to=None,
+                    min_amount=None, max_amount=None, limit=50):
+    """
+    Search stored documents by the indexed fields.
+    
+    Parameters:
+    vendor (str): Vendor name (normalized before matching)
+    document_number (str): Document number (normalized before matching)
+    date_from, date_to (str): Inclusive YYYY-MM-DD bounds on the document date
+    min_amount, max_amount (float): Inclusive bounds on the total amount
+    limit (int): Maximum number of documents to return
+    
+    Returns:
+    list: Document summaries, newest first
+    """
+    clauses, params = [], []
+    if vendor:
+        clauses.append("vendor_normalized = ?")
+        params.append(normalize_vendor(vendor))
+    if document_number:
+        clauses.append("document_number_normalized = ?")
+        params.append(normalize_document_number(document_number))
+    if date_from:
+        clauses.append("document_date >= ?")
+        params.append(date_from)
+    if date_to:
+        clauses.append("document_date <= ?")
+        params.append(date_to)
+    if min_amount is not None:
+        clauses.append("total_amount_cents >= ?")
+        params.append(int(round(min_amount * 100)))
+    if max_amount is not None:
+        clauses.append("total_amount_cents <= ?")
+        params.append(int(round(max_amount * 100)))
+    
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    params.append(limit)
+    with _store_lock:
+        rows = get_document_store().execute(
+            f"SELECT id, ingested_at, file_name, schema, document_type, vendor, document_number, "
+            f"document_date, total_amount_cents, currency, line_item_count, duplicate_of "
+            f"FROM documents {where} ORDER BY id DESC LIMIT ?",
+            params
+        ).fetchall()
+    
+    return [
+        {
+            "documentId": row["id"],
+            "ingestedAt": row["ingested_at"],
+            "fileName": row["file_name"],
+            "schema": row["schema"],
+            "documentType": row["document_type"],
+            "vendor": row["vendor"],
+            "documentNumber": row["document_number"],
+            "documentDate": row["document_date"],
+            "totalAmount": None if row["total_amount_cents"] is None else row["total_amount_cents"] / 100,
+            "currency": row["currency"],
+            "lineItemCount": row["line_item_count"],
+            "duplicateOf": row["duplicate_of"],
+        }
+        for row in rows
+    ]
+
+@app.get("/documents")
+async def list_documents(
+    vendor: Optional[str] = None,
+    document_number: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    min_amount: Optional[float] = None,
+    max_amount: Optional[float] = None,
+    limit: int = 50,
+    x_api_key: str = Header(""),
+):
+    if not DOCUMENT_STORE_PATH or not DOCUMENT_STORE_API_KEY:
+        return {"error": "Document store is disabled"}
+    if not secrets.compare_digest(x_api_key, DOCUMENT_STORE_API_KEY):
+        return JSONResponse(status_code=401, content={"error": "Invalid or missing API key"})
+    try:
+        documents = await asyncio.to_thread(
+            query_documents, vendor, document_number, date_from, date_to,
+            min_amount, max_amount, max(1, min(limit, 1000))
+        )
+        return {"response": documents}
+    except sqlite3.Error as e:
+        print(f"Error querying documents: {str(e)}")
+        return {"error": f"Error querying documents: {str(e)}"}
+
 # Define request model for vendor research
 class VendorResearchRequest(BaseModel):
     vendor_name: str